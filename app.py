@@ -9,17 +9,20 @@ import tempfile
 import shutil
 from pathlib import Path
 import asyncio
+import time
 import aiohttp
-import aiofiles
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Import the blur faces functionality
-from blur_faces import get_video_properties, get_face_encoding, get_blurred_face, decode_fourcc, has_audio
-import cv2
-import face_recognition
-import ffmpeg
+from blur_faces import (
+    get_video_properties, get_cached_face_encoding, get_blurred_face, decode_fourcc, has_audio,
+    read_frames, FrameWriter, FaceMatchTracker, batched, detect_faces_batch, get_detection_scale, select_faces_to_blur,
+    dilate_face_location, get_cnn_batch_size, get_hog_batch_size, open_video_capture, FFmpegVideoWriter,
+    DETECTION_INTERVAL, FACE_MARGIN, DETECTOR_WORKERS
+)
 import numpy as np
-from tqdm import trange
+from job_store import JobStore
 
 # Import optimized processor if available
 try:
@@ -43,6 +46,13 @@ app.add_middleware(
 
 # Set maximum file size (500MB)
 MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB in bytes
+# Uploads are written to disk in chunks of this size instead of being read into memory whole
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+# URL downloads are written in blocks of this size, logging progress every DOWNLOAD_LOG_INTERVAL blocks
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+DOWNLOAD_LOG_INTERVAL = 32
+# Least time in seconds between two progress writes to the job store
+PROGRESS_UPDATE_INTERVAL = 0.25
 
 # Create directories for uploads and processed videos
 UPLOAD_DIR = Path("uploads")
@@ -55,8 +65,31 @@ STATIC_DIR.mkdir(exist_ok=True)
 # Mount static files for processed videos
 app.mount("/processed", StaticFiles(directory="processed"), name="processed")
 
-# Store job status
-job_status = {}
+# Store job status; set REDIS_URL to share it between uvicorn workers
+job_status = JobStore(os.environ.get("REDIS_URL"))
+
+async def save_response_body(response: aiohttp.ClientResponse, output_path: str, log_progress: bool = False) -> int:
+    """Write a response body to disk in DOWNLOAD_CHUNK_SIZE blocks, returning the number of bytes written"""
+    loop = asyncio.get_running_loop()
+    downloaded = 0
+    chunks_written = 0
+    buffer = bytearray()
+    with open(output_path, 'wb') as f:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            # The network hands out smaller pieces; gather them so each write() is a full block
+            buffer += chunk
+            if len(buffer) < DOWNLOAD_CHUNK_SIZE:
+                continue
+            await loop.run_in_executor(None, f.write, buffer)
+            downloaded += len(buffer)
+            buffer = bytearray()
+            chunks_written += 1
+            if log_progress and chunks_written % DOWNLOAD_LOG_INTERVAL == 0:
+                print(f"[DEBUG] Downloaded {downloaded // (1024*1024)}MB")
+        if buffer:
+            await loop.run_in_executor(None, f.write, buffer)
+            downloaded += len(buffer)
+    return downloaded
 
 async def download_video_from_url(url: str, output_path: str) -> None:
     """Download video from URL to local file"""
@@ -87,13 +120,7 @@ async def download_video_from_url(url: str, output_path: str) -> None:
                 
                 # Download and save file
                 print(f"[DEBUG] Starting file download to: {output_path}")
-                downloaded = 0
-                async with aiofiles.open(output_path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(8192):
-                        await f.write(chunk)
-                        downloaded += len(chunk)
-                        if downloaded % (1024*1024) == 0:  # Log every MB
-                            print(f"[DEBUG] Downloaded {downloaded // (1024*1024)}MB")
+                downloaded = await save_response_body(response, output_path, log_progress=True)
                 
                 print(f"[DEBUG] Download completed. Total size: {downloaded} bytes")
                         
@@ -129,9 +156,7 @@ async def download_image_from_url(url: str, output_path: str) -> None:
                     print(f"[WARNING] Unexpected image content type: {content_type}")
                 
                 # Download and save file
-                async with aiofiles.open(output_path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(8192):
-                        await f.write(chunk)
+                await save_response_body(response, output_path)
                 
                 print(f"[DEBUG] Image download completed: {output_path}")
                         
@@ -144,6 +169,29 @@ async def download_image_from_url(url: str, output_path: str) -> None:
         print(f"[ERROR] {error_msg}")
         raise HTTPException(500, error_msg)
 
+def copy_upload_to_disk(src, output_path: Path) -> int:
+    """Copy an upload's spooled file to output_path in UPLOAD_CHUNK_SIZE blocks, returning the bytes copied"""
+    with open(output_path, 'wb') as f:
+        shutil.copyfileobj(src, f, length=UPLOAD_CHUNK_SIZE)
+        return f.tell()
+
+async def save_upload_file(upload: UploadFile, output_path: Path, description: str) -> None:
+    """Save an uploaded file to disk on the threadpool, rejecting it if it is larger than MAX_FILE_SIZE"""
+    too_large = HTTPException(413, f"{description} too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB")
+    # Starlette knows the size once the upload is received, so reject before copying anything
+    if upload.size is not None and upload.size > MAX_FILE_SIZE:
+        raise too_large
+    try:
+        loop = asyncio.get_running_loop()
+        copied = await loop.run_in_executor(None, copy_upload_to_disk, upload.file, output_path)
+        if copied > MAX_FILE_SIZE:
+            raise too_large
+    except Exception:
+        # Don't leave a partial upload behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
 @app.get("/")
 async def root():
     # Serve the HTML interface if it exists
@@ -165,16 +213,21 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
-async def process_video(
+def process_video(
     job_id: str,
     video_path: str,
     mode: str,
     model: str = "hog",
     censor_type: str = "gaussianblur",
     count: int = 1,
-    reference_faces: List[str] = None
+    reference_faces: List[str] = None,
+    min_face_size: int = 80,
+    detection_interval: int = DETECTION_INTERVAL
 ):
-    """Background task to process video"""
+    """Background task to process video
+
+    A plain function, so FastAPI runs it on its threadpool instead of blocking the event loop.
+    """
     try:
         job_status[job_id] = {"status": "processing", "progress": 0}
         
@@ -183,7 +236,7 @@ async def process_video(
         
         # Define progress callback
         def update_progress(progress):
-            job_status[job_id]["progress"] = progress
+            job_status.update(job_id, progress=progress)
         
         # Use optimized processor if available and model is HOG
         if OPTIMIZED_AVAILABLE and model == "hog":
@@ -216,105 +269,86 @@ async def process_video(
         print(f"[INFO] Using STANDARD processor for job {job_id}")
         
         # Open video
-        video_capture = cv2.VideoCapture(video_path)
-        width, height, length, fps, fourcc, codec = get_video_properties(video_capture)
-        
-        temp_video_path = PROCESSED_DIR / f"{job_id}_temp.mp4"
-        
-        # Create video writer with fallback codec support
-        # Try multiple codecs in order of preference
-        codecs_to_try = ["mp4v", "XVID", "MJPG", "X264"]
+        video_capture = open_video_capture(video_path)
         video_out = None
+        writer = None
+        try:
+            width, height, length, fps, fourcc, codec = get_video_properties(video_capture)
+            # Detect on downscaled frames; faces of min_face_size pixels stay detectable
+            detection_scale = get_detection_scale(height, count, min_face_size)
         
-        for codec in codecs_to_try:
-            try:
-                test_fourcc = cv2.VideoWriter_fourcc(*codec)
-                video_out = cv2.VideoWriter(
-                    str(temp_video_path), test_fourcc, fps, (width, height)
-                )
-                # Test if the writer was created successfully
-                if video_out.isOpened():
-                    print(f"Successfully created VideoWriter with codec: {codec}")
-                    break
-                else:
-                    video_out.release()
-                    video_out = None
-            except Exception as e:
-                print(f"Failed to create VideoWriter with codec {codec}: {e}")
-                if video_out:
-                    video_out.release()
-                    video_out = None
-        
-        if video_out is None:
-            raise Exception("Could not create VideoWriter with any available codec")
-        
-        # Get reference encodings if needed
-        reference_encodings = []
-        if mode in ["one", "allexcept"] and reference_faces:
-            for ref_face_path in reference_faces:
-                try:
-                    encoding = get_face_encoding(ref_face_path)
-                    reference_encodings.append(encoding)
-                except Exception as e:
-                    print(f"Error loading reference face {ref_face_path}: {e}")
+            # Frames are piped straight into ffmpeg, which encodes them once and muxes in the source audio
+            audio_path = video_path if has_audio(video_path) else None
+            video_out = FFmpegVideoWriter(output_path, width, height, fps, audio_path)
         
-        # Process frames with more frequent progress updates
-        for i in range(length + 1):
-            ret, frame = video_capture.read()
-            if not ret:
-                break
-            
-            # Update progress more frequently
-            if i % 5 == 0:  # Update every 5 frames
-                progress = int((i / length) * 100)
-                job_status[job_id]["progress"] = progress
-            
-            # Detect faces
-            face_locations = face_recognition.face_locations(
-                frame, number_of_times_to_upsample=count, model=model
-            )
-            
-            if mode == "all":
-                # Blur all faces
-                for face_location in face_locations:
-                    frame = get_blurred_face(frame, censor_type, face_location)
-            
-            elif mode == "one" and reference_encodings:
-                # Blur only matching faces
-                face_encodings = face_recognition.face_encodings(frame, face_locations)
-                for face_encoding, face_location in zip(face_encodings, face_locations):
-                    matches = face_recognition.compare_faces(reference_encodings, face_encoding)
-                    if any(matches):
-                        frame = get_blurred_face(frame, censor_type, face_location)
-            
-            elif mode == "allexcept" and reference_encodings:
-                # Blur all except matching faces
-                face_encodings = face_recognition.face_encodings(frame, face_locations)
-                for face_encoding, face_location in zip(face_encodings, face_locations):
-                    matches = face_recognition.compare_faces(reference_encodings, face_encoding)
-                    if not any(matches):
-                        frame = get_blurred_face(frame, censor_type, face_location)
-            
-            video_out.write(frame)
+            # Get reference encodings if needed
+            reference_encodings = []
+            if mode in ["one", "allexcept"] and reference_faces:
+                for ref_face_path in reference_faces:
+                    try:
+                        encoding = get_cached_face_encoding(ref_face_path)
+                        reference_encodings.append(encoding)
+                    except Exception as e:
+                        print(f"Error loading reference face {ref_face_path}: {e}")
         
-        # Release resources
-        video_capture.release()
-        video_out.release()
+            # Process frames: decode and encode run on their own threads,
+            # overlapping with face detection, which runs a batch at a time
+            writer = FrameWriter(video_out)
+            i = 0
+            last_progress = 0
+            last_progress_time = time.monotonic()
+            censored_locations = []
+            reused_locations = []
+            tracker = FaceMatchTracker(reference_encodings)
+            if model == "cnn":
+                # Fill the GPU: each batch carries as many detection frames as fit in memory
+                batch_size = get_cnn_batch_size((height, width), count, detection_scale, detection_interval) * detection_interval
+            else:
+                # Keep every detector thread busy: each batch carries one detection frame per thread or more
+                batch_size = get_hog_batch_size((height, width), detection_interval) * detection_interval
+            with ThreadPoolExecutor(max_workers=DETECTOR_WORKERS) as executor:
+                for frames in batched(read_frames(video_capture), batch_size):
+                    # Faces move only a few pixels between adjacent frames, so only
+                    # every detection_interval-th frame goes through the detector
+                    detection_frames = [frame for j, frame in enumerate(frames) if (i + j) % detection_interval == 0]
+                    batch_locations = iter(detect_faces_batch(detection_frames, model, count, executor, detection_scale))
+
+                    for frame in frames:
+                        # The frame count is only an estimate (it can be 0 or too low for
+                        # variable frame rate video), so clamp and only write when it changes
+                        progress = min(99, int(100 * i / max(length, 1)))
+                        if progress != last_progress and time.monotonic() - last_progress_time >= PROGRESS_UPDATE_INTERVAL:
+                            job_status.update(job_id, progress=progress)
+                            last_progress = progress
+                            last_progress_time = time.monotonic()
+
+                        if i % detection_interval == 0:
+                            # Decide which faces to blur, matching against the references if needed
+                            censored_locations = select_faces_to_blur(frame, next(batch_locations), mode, tracker)
+                            # In between detections reuse the boxes, widened to cover the motion
+                            reused_locations = [dilate_face_location(face_location, FACE_MARGIN, frame.shape)
+                                                for face_location in censored_locations]
+                            face_locations = censored_locations
+                        else:
+                            face_locations = reused_locations
+                        i += 1
+
+                        for face_location in face_locations:
+                            get_blurred_face(frame, censor_type, face_location)
+
+                        writer.write(frame)
+            writer.close()
+            video_out.release()
+        finally:
+            # Release resources, also when the job failed: the ffmpeg child and the writer thread
+            # would otherwise outlive it, still holding the output file open
+            if writer is not None:
+                writer.abort()
+            if video_out is not None:
+                video_out.abort()
+            video_capture.release()
         # Removed cv2.destroyAllWindows() - no GUI windows to destroy
         
-        # Add audio if present
-        if has_audio(video_path):
-            in_av = ffmpeg.input(video_path)
-            blurred_video = ffmpeg.input(str(temp_video_path))
-            stream = ffmpeg.output(
-                blurred_video, in_av.audio, str(output_path),
-                vcodec='libx264', crf=23, preset='fast'
-            ).overwrite_output()
-            ffmpeg.run(stream, quiet=True)
-            os.remove(temp_video_path)
-        else:
-            shutil.move(str(temp_video_path), str(output_path))
-        
         # Update job status
         job_status[job_id] = {
             "status": "completed",
@@ -355,18 +389,12 @@ async def blur_all_faces(
     if censor_type not in ["gaussianblur", "facemasking", "pixelation"]:
         raise HTTPException(400, "Invalid censor type")
     
-    # Check file size
-    content = await video.read()
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(413, f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB")
-    
     # Generate job ID
     job_id = str(uuid.uuid4())
     
-    # Save uploaded video
+    # Save uploaded video, checking its size as it streams to disk
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        f.write(content)
+    await save_upload_file(video, video_path, "File")
     
     # Start background processing
     background_tasks.add_task(
@@ -405,27 +433,28 @@ async def blur_specific_faces(
     if censor_type not in ["gaussianblur", "facemasking", "pixelation"]:
         raise HTTPException(400, "Invalid censor type")
     
-    # Check video file size
-    video_content = await video.read()
-    if len(video_content) > MAX_FILE_SIZE:
-        raise HTTPException(413, f"Video file too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB")
-    
     # Generate job ID
     job_id = str(uuid.uuid4())
     
-    # Save uploaded video
+    # Save uploaded video, checking its size as it streams to disk
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        f.write(video_content)
+    await save_upload_file(video, video_path, "Video file")
     
     # Save reference faces
     ref_paths = []
     for i, ref_face in enumerate(reference_faces):
         ref_path = UPLOAD_DIR / f"{job_id}_ref_{i}_{ref_face.filename}"
-        with open(ref_path, "wb") as f:
-            content = await ref_face.read()
-            f.write(content)
-        ref_paths.append(str(ref_path))
+        try:
+            await save_upload_file(ref_face, ref_path, "Reference image")
+            ref_paths.append(str(ref_path))
+        except Exception as e:
+            # Clean up any saved files
+            if os.path.exists(video_path):
+                os.remove(video_path)
+            for cleanup_path in ref_paths:
+                if os.path.exists(cleanup_path):
+                    os.remove(cleanup_path)
+            raise e
     
     # Start background processing
     background_tasks.add_task(
@@ -465,27 +494,28 @@ async def blur_all_except_specific_faces(
     if censor_type not in ["gaussianblur", "facemasking", "pixelation"]:
         raise HTTPException(400, "Invalid censor type")
     
-    # Check video file size
-    video_content = await video.read()
-    if len(video_content) > MAX_FILE_SIZE:
-        raise HTTPException(413, f"Video file too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB")
-    
     # Generate job ID
     job_id = str(uuid.uuid4())
     
-    # Save uploaded video
+    # Save uploaded video, checking its size as it streams to disk
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        f.write(video_content)
+    await save_upload_file(video, video_path, "Video file")
     
     # Save reference faces
     ref_paths = []
     for i, ref_face in enumerate(reference_faces):
         ref_path = UPLOAD_DIR / f"{job_id}_ref_{i}_{ref_face.filename}"
-        with open(ref_path, "wb") as f:
-            content = await ref_face.read()
-            f.write(content)
-        ref_paths.append(str(ref_path))
+        try:
+            await save_upload_file(ref_face, ref_path, "Reference image")
+            ref_paths.append(str(ref_path))
+        except Exception as e:
+            # Clean up any saved files
+            if os.path.exists(video_path):
+                os.remove(video_path)
+            for cleanup_path in ref_paths:
+                if os.path.exists(cleanup_path):
+                    os.remove(cleanup_path)
+            raise e
     
     # Start background processing
     background_tasks.add_task(
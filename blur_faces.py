@@ -1,11 +1,97 @@
 import os
+# Keep dlib's BLAS and OpenMP single-threaded; the pipeline runs its own detector threads.
+# Set before numpy/dlib load their thread pools, unless the environment already says otherwise.
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+# Skip probing the Media Foundation capture backend; videos are always opened through FFmpeg
+os.environ.setdefault('OPENCV_VIDEOIO_PRIORITY_MSMF', '0')
+import queue
+import hashlib
+import subprocess
+import threading
+from collections import OrderedDict
 import click
 import numpy as np
-import tempfile
+import functools
 import ffmpeg
 import face_recognition
+import dlib
 import cv2
-from tqdm import trange
+from tqdm import tqdm
+
+# diskcache is optional: without it reference encodings are only cached in memory
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+
+
+# Number of frames buffered between the decode, compute and encode stages
+PREFETCH_FRAMES = 8
+# Number of consecutive frames handed to the face detector at once
+DETECTION_BATCH_SIZE = 16
+# Frames are downscaled to about this height before face detection
+DETECTION_HEIGHT = 480
+# Smallest face (in pixels) dlib's detectors fire on without upsampling
+DETECTOR_WINDOW_SIZE = 80
+# Most frames the CNN detector gets per call when running on the GPU
+CNN_BATCH_SIZE = 128
+# Cap on the decoded frames held in memory while a detection batch fills up
+DETECTION_BUFFER_BYTES = 1024 ** 3
+# Run the face detector on every n-th frame and reuse its boxes in between
+DETECTION_INTERVAL = 5
+# Pixels added around reused boxes to cover the motion between detections
+FACE_MARGIN = 10
+# Minimum overlap for a detected face to continue a face seen at the previous detection
+TRACK_IOU_THRESHOLD = 0.4
+# Largest encoding distance at which two faces are the same person (face_recognition's default)
+FACE_MATCH_TOLERANCE = 0.6
+# Length of a face_recognition face encoding
+FACE_ENCODING_SIZE = 128
+# Size and padding of the aligned face chips dlib's ResNet encodes
+FACE_CHIP_SIZE = 150
+FACE_CHIP_PADDING = 0.25
+
+# Sigma of the gaussianblur censor, with the kernel size OpenCV derives from it for 8-bit images
+BLUR_SIGMA = 30
+_blur_kernel = cv2.getGaussianKernel(int(BLUR_SIGMA * 6 + 1) | 1, BLUR_SIGMA)
+
+# Cores are split between the pipeline stages: one for the reader, one for the writer
+# and the rest for the detector threads. OpenCV gets a share for its own resize/blur loops.
+CPU_COUNT = os.cpu_count() or 1
+DETECTOR_WORKERS = max(1, CPU_COUNT - 2)
+cv2.setNumThreads(max(1, CPU_COUNT // 3))
+
+# Hardware H.264/HEVC encoders in order of preference, with the ffmpeg output options each one needs;
+# libx264 is the software fallback
+VIDEO_ENCODERS = [
+    ('h264_nvenc', {'vcodec': 'h264_nvenc', 'preset': 'p4', 'rc': 'vbr', 'cq': 23}),
+    ('hevc_videotoolbox', {'vcodec': 'hevc_videotoolbox', 'b:v': '5M', 'tag:v': 'hvc1'}),
+]
+SOFTWARE_ENCODER_ARGS = {'vcodec': 'libx264', 'crf': 23, 'preset': 'fast'}
+
+# Built once per thread rather than per job: the HOG detector keeps scanner state between calls
+# and runs without the GIL, so the detector threads must not share one. The landmark and encoding
+# models are the ones face_recognition already loaded at import, so they are not held in memory twice.
+_detectors = threading.local()
+_pose_predictor = face_recognition.api.pose_predictor_5_point
+_face_encoder = face_recognition.api.face_encoder
+
+# Reference face encodings by SHA-256 of the image file, most recently used last
+REFERENCE_CACHE_SIZE = 512
+REFERENCE_CACHE_DIR = os.path.join('cache', 'refs')
+_reference_encodings = OrderedDict()
+_reference_lock = threading.Lock()
+
+
+def get_detector():
+    """The calling thread's HOG face detector, built on its first call"""
+    detector = getattr(_detectors, 'detector', None)
+    if detector is None:
+        detector = _detectors.detector = dlib.get_frontal_face_detector()
+    return detector
 
 
 def decode_fourcc(cc):
@@ -27,6 +113,93 @@ def has_audio(file_path):
         return False
 
 
+def encoder_works(encoder_args):
+    """Check that ffmpeg can actually encode with encoder_args, not just that the encoder was compiled in"""
+    # the same output options as the real encode, so a build that rejects one of them fails here
+    command = (
+        ffmpeg.input('color=size=256x256:duration=0.1', format='lavfi')
+        .output('-', format='null', pix_fmt='yuv420p', **encoder_args)
+        .global_args('-hide_banner', '-loglevel', 'error')
+        .compile()
+    )
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=30)
+        return result.returncode == 0
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def get_video_encoder_args():
+    """ffmpeg output options for the fastest working video encoder, probed once per process"""
+    for encoder, args in VIDEO_ENCODERS:
+        if encoder_works(args):
+            print(f"Using hardware video encoder: {encoder}")
+            return args
+    print("No hardware video encoder available, using libx264")
+    return SOFTWARE_ENCODER_ARGS
+
+
+def open_video_capture(video_path):
+    """Open video_path for reading, decoding on the GPU when OpenCV's FFmpeg backend supports it"""
+    video_capture = cv2.VideoCapture(
+        video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+    if not video_capture.isOpened():
+        # fall back to whichever backend can open the file
+        video_capture = cv2.VideoCapture(video_path)
+    acceleration = int(video_capture.get(cv2.CAP_PROP_HW_ACCELERATION))
+    print(f"VideoCapture hardware acceleration: {acceleration or 'none'}")
+    return video_capture
+
+
+class FFmpegVideoWriter:
+    """cv2.VideoWriter look-alike that pipes raw BGR frames into one ffmpeg process, which
+    encodes them with the fastest working encoder and muxes in the audio of audio_path"""
+
+    def __init__(self, output_path, width, height, fps, audio_path=None):
+        video = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='bgr24', s=f'{width}x{height}', r=fps)
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions: pad odd ones with one black row or column
+            video = video.filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+        streams = [video]
+        if audio_path is not None:
+            # only the audio is taken from the source, so its video is never decoded
+            streams.append(ffmpeg.input(audio_path).audio)
+        self.process = (
+            ffmpeg.output(*streams, str(output_path), pix_fmt='yuv420p', movflags='+faststart',
+                          **get_video_encoder_args())
+            .global_args('-hide_banner', '-loglevel', 'error')
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+        )
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.wait()} while encoding')
+
+    def release(self):
+        """Flush the remaining frames and wait for ffmpeg to finish the file"""
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.returncode} while encoding')
+
+    def abort(self):
+        """Stop ffmpeg without finishing the file, if release() hasn't already; for failed jobs"""
+        if self.process.poll() is None:
+            # killed before its stdin is closed, so it never writes a trailer into the output
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            # unflushed frames can't reach a dead process
+            pass
+        self.process.wait()
+
+
 def get_video_properties(video_capture):
     width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -37,11 +210,42 @@ def get_video_properties(video_capture):
     return width, height, length, fps, fourcc, codec
 
 
+def encode_faces(image, face_locations=None):
+    """Same as face_recognition.face_encodings, but on the shared models and with all faces in one descriptor call"""
+    if face_locations is None:
+        face_rects = list(get_detector()(image, 1))
+    else:
+        face_rects = [dlib.rectangle(left, top, right, bottom) for top, right, bottom, left in face_locations]
+    if not face_rects:
+        return []
+
+    shapes = dlib.full_object_detections()
+    for rect in face_rects:
+        shapes.append(_pose_predictor(image, rect))
+    return [np.array(descriptor) for descriptor in _face_encoder.compute_face_descriptor(image, shapes, 1)]
+
+
+def encode_faces_batch(frames, face_locations_batch):
+    """Encode the faces of several frames with a single descriptor call, as one (faces, 128) float32 array in frame order"""
+    chips = []
+    for frame, face_locations in zip(frames, face_locations_batch):
+        if not face_locations:
+            continue
+        shapes = dlib.full_object_detections()
+        for top, right, bottom, left in face_locations:
+            shapes.append(_pose_predictor(frame, dlib.rectangle(left, top, right, bottom)))
+        # aligned the same way compute_face_descriptor aligns a face from its landmarks
+        chips.extend(dlib.get_face_chips(frame, shapes, size=FACE_CHIP_SIZE, padding=FACE_CHIP_PADDING))
+    if not chips:
+        return np.empty((0, FACE_ENCODING_SIZE), dtype=np.float32)
+    return np.array(_face_encoder.compute_face_descriptor(chips, 1), dtype=np.float32)
+
+
 def get_face_encoding(in_face_file):
     try:
         face_to_blur = face_recognition.load_image_file(in_face_file)
         # expecting only 1 face in the image
-        face_to_blur_enc = face_recognition.face_encodings(face_to_blur)[0]
+        face_to_blur_enc = encode_faces(face_to_blur)[0]
         return face_to_blur_enc
     except FileNotFoundError:
         exit(f'file not found {in_face_file=}.')
@@ -49,20 +253,337 @@ def get_face_encoding(in_face_file):
         exit(f'no face found in the image file {in_face_file=}.')
 
 
+@functools.lru_cache(maxsize=None)
+def _get_reference_disk_cache():
+    if not DISKCACHE_AVAILABLE:
+        return None
+    return diskcache.Cache(REFERENCE_CACHE_DIR)
+
+
+def get_cached_face_encoding(in_face_file):
+    """Like get_face_encoding, but cached by image content in memory and, with diskcache, across restarts and workers"""
+    with open(in_face_file, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    with _reference_lock:
+        encoding = _reference_encodings.get(digest)
+        if encoding is not None:
+            _reference_encodings.move_to_end(digest)
+            return encoding
+
+    disk_cache = _get_reference_disk_cache()
+    encoding = disk_cache.get(digest) if disk_cache is not None else None
+    if encoding is None:
+        face_image = face_recognition.load_image_file(in_face_file)
+        encodings = encode_faces(face_image)
+        if not encodings:
+            raise ValueError(f'no face found in the image file {in_face_file=}.')
+        # expecting only 1 face in the image
+        encoding = encodings[0]
+        if disk_cache is not None:
+            disk_cache.set(digest, encoding)
+
+    with _reference_lock:
+        _reference_encodings[digest] = encoding
+        if len(_reference_encodings) > REFERENCE_CACHE_SIZE:
+            _reference_encodings.popitem(last=False)
+    return encoding
+
+
 def get_blurred_face(frame, censor_type, face_location):
+    """Censor one face of frame in place, touching only the face's pixels"""
     top, right, bottom, left = face_location
+    face_image = frame[top:bottom, left:right]
+    if face_image.size == 0:
+        return
     if censor_type == 'facemasking':
-        blurred_face = np.zeros((bottom-top, right-left, 3))
+        face_image[:] = 0
     elif censor_type == 'pixelation':
-        face_image = frame[top:bottom, left:right]
         h, w = face_image.shape[:2]
         resized_image = cv2.resize(face_image, (8, 8), interpolation=cv2.INTER_AREA)
-        blurred_face = cv2.resize(resized_image, (w, h), interpolation=cv2.INTER_AREA)
+        # upscale straight into the frame
+        cv2.resize(resized_image, (w, h), dst=face_image, interpolation=cv2.INTER_NEAREST)
     else:
-        face_image = frame[top:bottom, left:right]
-        blurred_face = cv2.GaussianBlur(face_image, (0, 0), 30)
-    frame[top:bottom, left:right] = blurred_face
-    return frame
+        # separable Gaussian: two 1-D passes instead of a 2-D kernel, written back over the face
+        cv2.sepFilter2D(face_image, -1, _blur_kernel, _blur_kernel, dst=face_image)
+
+
+def get_detection_scale(height, count, min_face_size=DETECTOR_WINDOW_SIZE):
+    """Scale factor for frames before detection, small enough to be fast but keeping faces of min_face_size pixels detectable"""
+    # each upsample halves the smallest face the detector can find
+    min_scale = DETECTOR_WINDOW_SIZE / (2 ** count * min_face_size)
+    return min(1.0, max(DETECTION_HEIGHT / height, min_scale))
+
+
+def scale_face_location(face_location, scale, frame_shape):
+    """Map a face location found on a frame resized by scale back onto the original frame"""
+    height, width = frame_shape[:2]
+    top, right, bottom, left = (int(v / scale) for v in face_location)
+    return max(0, top), min(width, right), min(height, bottom), max(0, left)
+
+
+def dilate_face_location(face_location, margin, frame_shape):
+    height, width = frame_shape[:2]
+    top, right, bottom, left = face_location
+    return max(0, top - margin), min(width, right + margin), min(height, bottom + margin), max(0, left - margin)
+
+
+def face_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) face locations"""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def match_faces(reference_matrix, face_encodings, tolerance=FACE_MATCH_TOLERANCE):
+    """For each face encoding, whether it is within tolerance of any row of reference_matrix"""
+    queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, reference_matrix.shape[1])
+    # all query/reference squared distances at once: |q|^2 + |r|^2 - 2 q.r
+    distances = ((queries ** 2).sum(axis=1)[:, None] + (reference_matrix ** 2).sum(axis=1)[None, :]
+                 - 2 * queries @ reference_matrix.T)
+    return (distances <= tolerance ** 2).any(axis=1)
+
+
+class FaceMatchTracker:
+    """Track faces across detections so that each identity is encoded and compared to the references only once"""
+
+    def __init__(self, reference_encodings, iou_threshold=TRACK_IOU_THRESHOLD):
+        self.reference_encodings = reference_encodings
+        # stacked once, so every comparison is a single matrix operation
+        self.reference_matrix = np.array(reference_encodings, dtype=np.float32).reshape(-1, FACE_ENCODING_SIZE)
+        self.iou_threshold = iou_threshold
+        # (face_location, matches_a_reference) for every face seen at the last detection
+        self.tracks = []
+
+    def match(self, frame, face_locations):
+        """Return, for each face location, whether it matches any of the reference faces"""
+        unclaimed = list(self.tracks)
+        matches = []
+        new_faces = []
+        for i, face_location in enumerate(face_locations):
+            best = max(unclaimed, key=lambda track: face_iou(track[0], face_location), default=None)
+            if best is not None and face_iou(best[0], face_location) >= self.iou_threshold:
+                # same face as at the last detection, reuse its decision
+                unclaimed.remove(best)
+                matches.append(best[1])
+            else:
+                matches.append(None)
+                new_faces.append(i)
+
+        if new_faces:
+            face_encodings = encode_faces(frame, [face_locations[i] for i in new_faces])
+            for i, matched in zip(new_faces, match_faces(self.reference_matrix, face_encodings)):
+                matches[i] = bool(matched)
+
+        # faces that were not detected again are dropped
+        self.tracks = list(zip(face_locations, matches))
+        return matches
+
+
+def select_faces_to_blur(frame, face_locations, mode, tracker):
+    """Return the face locations to censor in frame: all of them, those matching a reference (one) or the rest (allexcept)"""
+    if mode == 'all':
+        return face_locations
+    if tracker is None or not tracker.reference_encodings:
+        return []
+
+    matches = tracker.match(frame, face_locations)
+    # mode 'one' blurs the matching faces, 'allexcept' the others
+    return [face_location for face_location, matched in zip(face_locations, matches) if matched == (mode == 'one')]
+
+
+def resize_for_detection(image, scale):
+    if scale < 1.0:
+        return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def to_detection_gray(frame, scale=1.0, buffers=None):
+    """Downscaled grayscale copy of frame for the HOG detector, written into the arrays in buffers when given"""
+    if buffers is None:
+        buffers = {}
+    height, width = frame.shape[:2]
+    size = (max(1, round(width * scale)), max(1, round(height * scale))) if scale < 1.0 else (width, height)
+    if buffers.get('gray') is None or buffers['gray'].shape != size[::-1]:
+        buffers['small'] = np.empty(size[::-1] + (3,), dtype=np.uint8)
+        buffers['gray'] = np.empty(size[::-1], dtype=np.uint8)
+    # downscale first, so the full-size frame is read only once and the colour conversion runs on the small one
+    small = frame
+    if scale < 1.0:
+        small = cv2.resize(frame, size, dst=buffers['small'], interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=buffers['gray'])
+
+
+def detect_faces_hog(frame, count, scale=1.0, buffers=None):
+    """Find faces with dlib's HOG detector, which only looks at gradients, on a grayscale copy of frame"""
+    gray = to_detection_gray(frame, scale, buffers)
+    height, width = gray.shape
+    return [(max(rect.top(), 0), min(rect.right(), width), min(rect.bottom(), height), max(rect.left(), 0))
+            for rect in get_detector()(gray, count)]
+
+
+def get_free_gpu_memory():
+    """Free memory of the first NVIDIA GPU in bytes, or None if it can't be queried"""
+    try:
+        result = subprocess.run(['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+                                capture_output=True, text=True, timeout=10)
+        return int(result.stdout.split()[0]) * 1024 * 1024
+    except (FileNotFoundError, subprocess.TimeoutExpired, IndexError, ValueError):
+        return None
+
+
+def cap_batch_to_buffer(batch_size, frame_shape, detection_interval):
+    """batch_size detection frames, or as many as fit in DETECTION_BUFFER_BYTES of decoded frames"""
+    height, width = frame_shape[:2]
+    # every detected frame is followed by detection_interval - 1 frames waiting for its result
+    return max(1, min(batch_size, DETECTION_BUFFER_BYTES // (height * width * 3 * detection_interval)))
+
+
+def get_hog_batch_size(frame_shape, detection_interval):
+    """Frames per HOG detection batch: at least one for every detector thread"""
+    # the batch ends in a barrier, so with fewer detection frames than threads some would idle
+    return cap_batch_to_buffer(max(DETECTION_BATCH_SIZE, DETECTOR_WORKERS), frame_shape, detection_interval)
+
+
+def get_cnn_batch_size(frame_shape, count, scale, detection_interval):
+    """Frames per CNN detector call: as many as fit in GPU memory and DETECTION_BUFFER_BYTES of decoded frames"""
+    if not dlib.DLIB_USE_CUDA:
+        # batching only pays off on the GPU
+        return cap_batch_to_buffer(DETECTION_BATCH_SIZE, frame_shape, detection_interval)
+    height, width = frame_shape[:2]
+    batch_size = CNN_BATCH_SIZE
+    free_memory = get_free_gpu_memory()
+    if free_memory is not None:
+        # float32 RGB input, grown by each upsample
+        input_bytes = int(height * scale * width * scale) * 3 * 4 * 4 ** count
+        batch_size = min(batch_size, free_memory // input_bytes)
+    return cap_batch_to_buffer(batch_size, frame_shape, detection_interval)
+
+
+def detect_faces_batch(frames, model, count, executor=None, scale=1.0):
+    """Detect faces in a list of frames, returning the face locations of each frame in order"""
+    if model == 'cnn':
+        # the CNN detector batches natively; it wants contiguous RGB images
+        small_frames = [cv2.cvtColor(resize_for_detection(frame, scale), cv2.COLOR_BGR2RGB) for frame in frames]
+        batch_locations = face_recognition.batch_face_locations(
+            small_frames, number_of_times_to_upsample=count, batch_size=len(small_frames))
+    else:
+        def detect(frame):
+            return detect_faces_hog(frame, count, scale)
+
+        if executor is None:
+            batch_locations = [detect(frame) for frame in frames]
+        else:
+            # dlib releases the GIL while running HOG, so the frames are detected in parallel;
+            # each executor thread runs its own detector (get_detector), which is not thread-safe
+            batch_locations = list(executor.map(detect, frames))
+
+    if scale < 1.0:
+        batch_locations = [[scale_face_location(face_location, scale, frame.shape) for face_location in face_locations]
+                           for frame, face_locations in zip(frames, batch_locations)]
+    return batch_locations
+
+
+def batched(iterable, batch_size):
+    """Yield lists of up to batch_size consecutive items from iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_frames(video_capture, prefetch=PREFETCH_FRAMES, step=1):
+    """Yield frames from video_capture, decoding ahead on a background thread
+
+    With step > 1 only every step-th frame is decoded; the others are grabbed and dropped.
+    """
+    read_q = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def reader():
+        index = 0
+        while not stop.is_set():
+            # grab() only demuxes, retrieve() decodes
+            ret = video_capture.grab()
+            if ret and index % step == 0:
+                ret, frame = video_capture.retrieve()
+                if ret:
+                    read_q.put(frame)
+            if not ret:
+                # sentinel: end of stream
+                read_q.put(None)
+                break
+            index += 1
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            frame = read_q.get()
+            if frame is None:
+                break
+            yield frame
+    finally:
+        # unblock the reader if the consumer stopped early, so the capture can be released safely
+        stop.set()
+        while thread.is_alive():
+            try:
+                read_q.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+class FrameWriter:
+    """Write frames to video_out on a background thread so encoding overlaps with detection"""
+
+    def __init__(self, video_out, prefetch=PREFETCH_FRAMES):
+        self.video_out = video_out
+        self.write_q = queue.Queue(maxsize=prefetch)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            frame = self.write_q.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.video_out.write(frame)
+                except Exception as e:
+                    # keep draining so the producer never blocks on a full queue
+                    self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.write_q.put(frame)
+
+    def close(self):
+        """Flush queued frames and wait for the writer thread to finish"""
+        self.write_q.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Stop the writer thread without writing the frames still queued, if close() hasn't already"""
+        if not self.thread.is_alive():
+            return
+        if self.error is None:
+            # the thread skips the rest of the queue once there is an error
+            self.error = RuntimeError('writer aborted')
+        self.write_q.put(None)
+        self.thread.join()
 
 
 @click.command()
@@ -79,105 +600,54 @@ def blurfaces(mode, model, censor_type, count, in_face_file, in_video_file):
     print(f'{mode=}, {model=}, {censor_type=}, {count=}, in_face_files={in_face_files}')
 
     _, file_extension = os.path.splitext(in_video_file)
+    audio_path = in_video_file if has_audio(in_video_file) else None
 
-    in_av_file = ffmpeg.input(in_video_file)
-    a1 = in_av_file.audio if has_audio(in_video_file) else None
+    if mode in ('one', 'allexcept'):
+        if not in_face_files:
+            exit(f'--in-face-file must be provided at least once when mode is "{mode}".')
+        # get encodings for all provided reference faces
+        reference_encodings = [get_face_encoding(f) for f in in_face_files]
 
     video_capture = cv2.VideoCapture(in_video_file)
     width, height, length, fps, fourcc, codec = get_video_properties(video_capture)
     print(f'{width=}, {height=}, {length=}, {fps=}, {codec=}')
 
-    with tempfile.NamedTemporaryFile(suffix=file_extension) as out_video_file:
-        # Try multiple codecs with fallback support
-        codecs_to_try = ["mp4v", "XVID", "MJPG", "X264"]
-        video_out = None
-        
-        for codec in codecs_to_try:
-            try:
-                test_fourcc = cv2.VideoWriter_fourcc(*codec)
-                video_out = cv2.VideoWriter(
-                    out_video_file.name, test_fourcc, fps, (width, height)
-                )
-                # Test if the writer was created successfully
-                if video_out.isOpened():
-                    print(f"Successfully created VideoWriter with codec: {codec}")
-                    break
-                else:
-                    video_out.release()
-                    video_out = None
-            except Exception as e:
-                print(f"Failed to create VideoWriter with codec {codec}: {e}")
-                if video_out:
-                    video_out.release()
-                    video_out = None
-        
-        if video_out is None:
-            exit("Could not create VideoWriter with any available codec")
-
-        face_locations = []
-        if mode == 'one':
-            if not in_face_files:
-                exit('--in-face-file must be provided at least once when mode is "one".')
-
-            # get encodings for all provided reference faces
-            reference_encodings = [get_face_encoding(f) for f in in_face_files]
-
-            for i in trange(length+1):
-                ret, frame = video_capture.read()
-                if not ret:
-                    video_out.release()
-                    break
+    # frames are encoded once, straight into the output file together with the audio
+    video_out = FFmpegVideoWriter('out' + file_extension, width, height, fps, audio_path)
 
-                face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=count, model=model)
-                face_image_encodings = face_recognition.face_encodings(frame, face_locations)
-
-                # iterate over each face detected in the frame
-                for face_encoding, face_location in zip(face_image_encodings, face_locations):
-                    # check if this face matches ANY of the provided reference encodings
-                    matches = face_recognition.compare_faces(reference_encodings, face_encoding)
-                    if any(matches):
-                        frame = get_blurred_face(frame, censor_type, face_location)
-                video_out.write(frame)
+    # the frame count is only an estimate (variable frame rate), so read until EOF
+    progress = tqdm(total=length)
+    while True:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        progress.update()
 
+        face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=count, model=model)
+        if mode == 'one':
+            face_image_encodings = encode_faces(frame, face_locations)
+            # iterate over each face detected in the frame
+            for face_encoding, face_location in zip(face_image_encodings, face_locations):
+                # check if this face matches ANY of the provided reference encodings
+                matches = face_recognition.compare_faces(reference_encodings, face_encoding)
+                if any(matches):
+                    get_blurred_face(frame, censor_type, face_location)
         elif mode == 'allexcept':
-            if not in_face_files:
-                exit('--in-face-file must be provided at least once when mode is "allexcept".')
-            reference_encodings = [get_face_encoding(f) for f in in_face_files]
-
-            for i in trange(length+1):
-                ret, frame = video_capture.read()
-                if not ret:
-                    video_out.release()
-                    break
-
-                face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=count, model=model)
-                face_image_encodings = face_recognition.face_encodings(frame, face_locations)
-
-                for face_encoding, face_location in zip(face_image_encodings, face_locations):
-                    matches = face_recognition.compare_faces(reference_encodings, face_encoding)
-                    # blur faces that DO NOT match any reference face
-                    if not any(matches):
-                        frame = get_blurred_face(frame, censor_type, face_location)
-                video_out.write(frame)
+            face_image_encodings = encode_faces(frame, face_locations)
+            for face_encoding, face_location in zip(face_image_encodings, face_locations):
+                matches = face_recognition.compare_faces(reference_encodings, face_encoding)
+                # blur faces that DO NOT match any reference face
+                if not any(matches):
+                    get_blurred_face(frame, censor_type, face_location)
         else:  # mode = all
-            for i in trange(length+1):
-                ret, frame = video_capture.read()
-                if not ret:
-                    video_out.release()
-                    break
-
-                face_locations = face_recognition.face_locations(frame, number_of_times_to_upsample=count, model=model)
-                for face_location in face_locations:
-                    frame = get_blurred_face(frame, censor_type, face_location)
-                video_out.write(frame)
-
-        video_capture.release()
-        # Removed cv2.destroyAllWindows() - no GUI windows to destroy
-
-        blurred_video_input = ffmpeg.input(out_video_file.name)
-        streams = [blurred_video_input, a1] if a1 else [blurred_video_input]
-        stream = ffmpeg.output(*streams, 'out' + file_extension).overwrite_output()
-        ffmpeg.run(stream)
+            for face_location in face_locations:
+                get_blurred_face(frame, censor_type, face_location)
+        video_out.write(frame)
+
+    progress.close()
+    video_out.release()
+    video_capture.release()
+    # Removed cv2.destroyAllWindows() - no GUI windows to destroy
 
     return 0
 
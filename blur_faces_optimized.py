@@ -2,28 +2,227 @@ import os
 import cv2
 import face_recognition
 import numpy as np
+import multiprocessing
+from collections import deque
 from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import ffmpeg
 from pathlib import Path
 import time
 from functools import partial
+from blur_faces import (
+    read_frames, batched, match_faces, encode_faces_batch, detect_faces_hog, FFmpegVideoWriter, FACE_ENCODING_SIZE,
+    FACE_MATCH_TOLERANCE, get_cached_face_encoding, to_detection_gray
+)
+
+# numba is optional: with it, all the faces of a frame are pixelated in one compiled call
+try:
+    import numba
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Cap on the decoded frames held in shared memory for the worker processes
+SHARED_MEMORY_BYTES = 1024 ** 3
+# Share of the free space in /dev/shm one job may take, leaving room for concurrent jobs
+SHARED_MEMORY_FRACTION = 0.5
+
+
+def get_shared_memory_budget():
+    """Bytes of shared memory a job may allocate: SHARED_MEMORY_BYTES, or less if /dev/shm is smaller"""
+    try:
+        stats = os.statvfs('/dev/shm')
+    except (AttributeError, OSError):
+        # no tmpfs-backed /dev/shm (macOS, Windows): shared memory is not limited by a mount
+        return SHARED_MEMORY_BYTES
+    # Pages of a tmpfs that is full fault with SIGBUS when touched, which kills the process,
+    # so blocks must fit in the free space up front
+    return min(SHARED_MEMORY_BYTES, int(stats.f_bavail * stats.f_frsize * SHARED_MEMORY_FRACTION))
+
+# Stack blur (OpenCV >= 4.7) costs the same per pixel whatever the kernel size; the box filter
+# it falls back to is a rolling sum too. Either hides a face as well as a Gaussian does.
+_fast_blur = getattr(cv2, 'stackBlur', cv2.blur)
+# Kernel size of the gaussianblur censor
+BLUR_KERNEL_SIZE = 21
+
+# A CUDA build of OpenCV with a device blurs the faces on the GPU instead, a whole frame per upload
+try:
+    CUDA_AVAILABLE = (hasattr(cv2.cuda, 'createGaussianFilter')
+                      and cv2.cuda.getCudaEnabledDeviceCount() > 0)
+except (AttributeError, cv2.error):
+    CUDA_AVAILABLE = False
+# Spread of stack blur's tent kernel of the same size, so the GPU Gaussian hides a face as well
+CUDA_BLUR_SIGMA = ((BLUR_KERNEL_SIZE // 2) * (BLUR_KERNEL_SIZE // 2 + 2) / 6) ** 0.5
+
+# Components of dlib face encodings have been seen up to about 0.53 in magnitude, so with numba
+# they are compared as int8 at 127 / 0.6 steps per unit, which leaves headroom before clipping
+INT8_ENCODING_SCALE = 127 / 0.6
+
+# MOSSE correlation trackers ship with opencv-contrib (in requirements.txt); without them, boxes are reused as they are between detections
+TRACKERS_AVAILABLE = hasattr(getattr(cv2, 'legacy', None), 'TrackerMOSSE_create')
+
+
+def _make_pixelate_kernel(height, width):
+    """Compile the pixelation kernel for height x width frames, with the frame size as a constant"""
+    # A closure over the frame size; numba's on-disk cache keeps one compiled copy per resolution
+    @njit(parallel=True, fastmath=True, cache=True)
+    def pixelate_faces(frame, boxes):
+        """Pixelate each (top, right, bottom, left) box of frame in place, the same way get_blurred_face_fast does"""
+        for i in range(boxes.shape[0]):
+            # same boundary checks as get_blurred_face_fast, against the constant frame size
+            top, bottom = min(max(boxes[i, 0], 0), height), min(max(boxes[i, 2], 0), height)
+            left, right = min(max(boxes[i, 3], 0), width), min(max(boxes[i, 1], 0), width)
+            h, w = bottom - top, right - left
+            if h <= 0 or w <= 0:
+                continue
+            # 8x8 tiles, or a single one for faces under 8 pixels
+            tiles = 8 if h >= 8 and w >= 8 else 1
+            bh, bw = h // tiles, w // tiles
+            # tiles never overlap, so they can be done in parallel
+            for tile in prange(tiles * tiles):
+                ty, tx = tile // tiles, tile % tiles
+                y0, x0 = top + ty * bh, left + tx * bw
+                # the last row and column of tiles also cover the remainder
+                y1 = bottom if ty == tiles - 1 else y0 + bh
+                x1 = right if tx == tiles - 1 else x0 + bw
+                # averaged over whole tiles only, like the NumPy version
+                sy1 = y1 if tiles == 1 else y0 + bh
+                sx1 = x1 if tiles == 1 else x0 + bw
+                n = (sy1 - y0) * (sx1 - x0)
+                for c in range(3):
+                    s = 0
+                    for y in range(y0, sy1):
+                        for x in range(x0, sx1):
+                            s += frame[y, x, c]
+                    mean = s // n
+                    for y in range(y0, y1):
+                        for x in range(x0, x1):
+                            frame[y, x, c] = mean
+
+    return pixelate_faces
+
+
+if NUMBA_AVAILABLE:
+    @njit(fastmath=True, cache=True)
+    def _match_faces_int8(queries, references, threshold):
+        """match_faces on int8 encodings: whether each query is within the squared distance threshold of a reference"""
+        matches = np.zeros(queries.shape[0], dtype=np.bool_)
+        for i in range(queries.shape[0]):
+            for j in range(references.shape[0]):
+                # int32 accumulator over int8 differences, which LLVM vectorizes
+                distance = 0
+                for d in range(queries.shape[1]):
+                    diff = np.int32(queries[i, d]) - np.int32(references[j, d])
+                    distance += diff * diff
+                if distance <= threshold:
+                    matches[i] = True
+                    break
+        return matches
+
+
+def quantize_encodings(encodings):
+    """Face encodings as an (n, 128) int8 array, at INT8_ENCODING_SCALE steps per unit"""
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, FACE_ENCODING_SIZE)
+    return np.clip(np.rint(encodings * INT8_ENCODING_SCALE), -127, 127).astype(np.int8)
+
+
+# Set in each worker process by _init_shared_worker
+_worker = None
+# CUDA stream, filter and device buffers, created on a worker's first GPU blur
+_cuda = None
+
+
+def _blur_faces_cuda(frame, boxes):
+    """Gaussian blur each (top, right, bottom, left) box of frame in place on the GPU, with one upload and download"""
+    global _cuda
+    if _cuda is None:
+        # CUDA filters take 1 or 4 channel images, so the frame goes through the GPU as BGRA
+        gaussian = cv2.cuda.createGaussianFilter(cv2.CV_8UC4, cv2.CV_8UC4, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE),
+                                                 CUDA_BLUR_SIGMA)
+        _cuda = (cv2.cuda.Stream(), gaussian, cv2.cuda_GpuMat(), cv2.cuda_GpuMat())
+    stream, gaussian, gpu_frame, gpu_blurred = _cuda
+    gpu_frame.upload(frame, stream)
+    gpu_bgra = cv2.cuda.cvtColor(gpu_frame, cv2.COLOR_BGR2BGRA, stream=stream)
+    for top, right, bottom, left in boxes:
+        if min(bottom - top, right - left) <= BLUR_KERNEL_SIZE:
+            # too small to reflect the kernel at the borders, so it is left for the CPU below
+            continue
+        face_region = cv2.cuda_GpuMat(gpu_bgra, (int(left), int(top), int(right - left), int(bottom - top)))
+        # filtered out of place, as the kernel would otherwise read pixels it has already blurred
+        gaussian.apply(face_region, gpu_blurred, stream)
+        gpu_blurred.copyTo(stream, face_region)
+    gpu_frame = cv2.cuda.cvtColor(gpu_bgra, cv2.COLOR_BGRA2BGR, stream=stream)
+    gpu_frame.download(stream, frame)
+    stream.waitForCompletion()
+    for top, right, bottom, left in boxes:
+        if 0 < min(bottom - top, right - left) <= BLUR_KERNEL_SIZE:
+            frame[top:bottom, left:right] = _fast_blur(frame[top:bottom, left:right],
+                                                       (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE))
+
+
+def _init_shared_worker(processor, block_names, block_shape, mode, reference_encodings):
+    """Attach a worker process to the shared frame blocks, once for the whole video"""
+    global _worker
+    # Each worker is one of num_workers parallel processes, so neither OpenCV nor numba
+    # should start a thread pool in it
+    cv2.setNumThreads(1)
+    if NUMBA_AVAILABLE:
+        numba.set_num_threads(1)
+    blocks = [SharedMemory(name=name) for name in block_names]
+    views = [np.ndarray(block_shape, dtype=np.uint8, buffer=block.buf) for block in blocks]
+    _worker = (processor, blocks, views, mode, reference_encodings)
+
+
+def _process_shared_batch(block_id, n_frames, detect_flags=None):
+    """Detect, match and blur the faces of the frames in a shared block, in place"""
+    processor, _, views, mode, reference_encodings = _worker
+    frames = list(views[block_id][:n_frames])
+    if detect_flags is None:
+        detect_flags = processor.motion_detect_flags(frames)
+    # Every batch starts on a detection frame, so nothing carries over from the previous one
+    face_locations_batch = processor.locate_faces_batch(frames, detect_flags, [])
+    processor.process_frame_batch(frames, face_locations_batch, reference_encodings, mode)
+
 
 class OptimizedVideoProcessor:
-    def __init__(self, model='hog', censor_type='gaussianblur', count=1):
+    # Pixelation kernels by (height, width), shared by every processor in a process
+    _kernel_cache = {}
+
+    def __init__(self, model='hog', censor_type='gaussianblur', count=1, detect_only=False):
         self.model = model
         self.censor_type = censor_type
         self.count = count
         self.scale_factor = 0.5  # Process at 50% resolution for face detection
-        self.skip_frames = 2  # Process every 2nd frame for face detection
+        self.skip_frames = 2  # Process every 2nd frame for face detection when detect_only
+        # Only keep the detection frames, writing a video at 1/skip_frames of the frame rate;
+        # the dropped frames are never decoded
+        self.detect_only = detect_only
+        # Otherwise detect again only once the scene has changed by motion_threshold grey levels on
+        # average since the last detection, or after max_skip_frames frames at the latest
+        self.motion_threshold = 4.0
+        self.max_skip_frames = 15
+        # Reference encodings stacked into one matrix, set per video in process_video_optimized
+        self.ref_matrix = np.empty((0, FACE_ENCODING_SIZE), dtype=np.float32)
+        self.ref_int8 = quantize_encodings(self.ref_matrix)
+        # Scratch arrays for the downscaled detection and motion frames, allocated on first use
+        self.detection_buffers = {}
+        self.motion_buffers = {}
         self.batch_size = 32  # Process 32 frames at once (increased for more cores)
         self.num_workers = min(cpu_count(), 8)  # Use up to 8 cores on c4.2xlarge
         print(f"[OPTIMIZED] Detected {cpu_count()} CPU cores, using {self.num_workers} workers")
         
     def detect_faces_scaled(self, frame):
         """Detect faces at lower resolution for speed"""
+        if self.model == 'hog':
+            # HOG only looks at gradients, so it gets a downscaled grayscale frame: a third of the pixels
+            # to copy, and no colour conversion inside face_recognition. The same two scratch arrays are
+            # reused for every frame of the video
+            return self.scale_locations(detect_faces_hog(frame, self.count, self.scale_factor,
+                                                         self.detection_buffers))
+        
         # Downscale for detection
-        height, width = frame.shape[:2]
         small_frame = cv2.resize(frame, None, fx=self.scale_factor, fy=self.scale_factor)
         
         # Detect faces on smaller frame
@@ -32,8 +231,24 @@ class OptimizedVideoProcessor:
             number_of_times_to_upsample=self.count, 
             model=self.model
         )
+        return self.scale_locations(face_locations)
+    
+    def detect_faces_batch_scaled(self, frames):
+        """detect_faces_scaled for a list of frames; the CNN model gets them all in one batched forward pass"""
+        if self.model != 'cnn' or not frames:
+            # HOG has no batch API
+            return [self.detect_faces_scaled(frame) for frame in frames]
         
-        # Scale locations back to original size
+        small_frames = [cv2.resize(frame, None, fx=self.scale_factor, fy=self.scale_factor) for frame in frames]
+        batch_locations = face_recognition.batch_face_locations(
+            small_frames,
+            number_of_times_to_upsample=self.count,
+            batch_size=len(small_frames)
+        )
+        return [self.scale_locations(face_locations) for face_locations in batch_locations]
+    
+    def scale_locations(self, face_locations):
+        """Scale locations found on a downscaled frame back to original size"""
         scaled_locations = []
         for top, right, bottom, left in face_locations:
             scaled_locations.append((
@@ -45,6 +260,70 @@ class OptimizedVideoProcessor:
         
         return scaled_locations
     
+    def locate_faces_batch(self, frames, detect_flags, last_face_locations):
+        """Face locations for each frame: detected where detect_flags is set, tracked from the previous detection elsewhere"""
+        detected = iter(self.detect_faces_batch_scaled(
+            [frame for frame, detect in zip(frames, detect_flags) if detect]))
+        face_locations_batch = []
+        trackers = []
+        for frame, detect in zip(frames, detect_flags):
+            if detect:
+                last_face_locations = next(detected)
+                if TRACKERS_AVAILABLE:
+                    trackers = self.start_trackers(frame, last_face_locations)
+            elif trackers:
+                tracked_locations = self.update_trackers(frame, trackers)
+                if tracked_locations is None:
+                    # A face was lost (turned away, occluded, out of frame): detect again right here
+                    last_face_locations = self.detect_faces_scaled(frame)
+                    trackers = self.start_trackers(frame, last_face_locations)
+                else:
+                    last_face_locations = tracked_locations
+            # Without trackers, reuse previous face locations (assuming faces don't move much)
+            face_locations_batch.append(last_face_locations)
+        return face_locations_batch
+    
+    def motion_detect_flags(self, frames):
+        """Detect on the first frame, then again once the scene has moved or max_skip_frames have passed"""
+        detect_flags = []
+        last_detected = None
+        for frame in frames:
+            # mean absolute difference from the last detection frame: one pass over the small grey frame
+            gray = to_detection_gray(frame, self.scale_factor, self.motion_buffers)
+            detect = (last_detected is None or len(detect_flags) - last_detected[0] >= self.max_skip_frames
+                      or cv2.norm(gray, last_detected[1], cv2.NORM_L1) / gray.size > self.motion_threshold)
+            if detect:
+                last_detected = (len(detect_flags), gray.copy())
+            detect_flags.append(detect)
+        return detect_flags
+    
+    def start_trackers(self, frame, face_locations):
+        """Start one MOSSE tracker per face on the frame the faces were detected in"""
+        height, width = frame.shape[:2]
+        trackers = []
+        for top, right, bottom, left in face_locations:
+            top, left = max(0, top), max(0, left)
+            bottom, right = min(height, bottom), min(width, right)
+            if bottom <= top or right <= left:
+                continue
+            tracker = cv2.legacy.TrackerMOSSE_create()
+            tracker.init(frame, (left, top, right - left, bottom - top))
+            trackers.append(tracker)
+        return trackers
+    
+    def update_trackers(self, frame, trackers):
+        """Follow each tracked face into frame, or return None if any of them was lost"""
+        height, width = frame.shape[:2]
+        face_locations = []
+        for tracker in trackers:
+            ok, (x, y, w, h) = tracker.update(frame)
+            top, right, bottom, left = max(0, int(y)), min(width, int(x + w)), min(height, int(y + h)), max(0, int(x))
+            # a box that drifted off the frame is empty once clamped, which is as good as lost
+            if not ok or bottom <= top or right <= left:
+                return None
+            face_locations.append((top, right, bottom, left))
+        return face_locations
+    
     def get_blurred_face_fast(self, frame, face_location):
         """Optimized blur function"""
         top, right, bottom, left = face_location
@@ -60,47 +339,89 @@ class OptimizedVideoProcessor:
             frame[top:bottom, left:right] = 0
         elif self.censor_type == 'pixelation':
             face_region = frame[top:bottom, left:right]
-            # Faster pixelation
-            small = cv2.resize(face_region, (8, 8), interpolation=cv2.INTER_LINEAR)
-            pixelated = cv2.resize(small, (right-left, bottom-top), interpolation=cv2.INTER_NEAREST)
-            frame[top:bottom, left:right] = pixelated
+            h, w = face_region.shape[:2]
+            bh, bw = h // 8, w // 8
+            if bh and bw:
+                # Mean colour of each of the 8x8 tiles, in one reduction over a tile view of the face
+                tiles = face_region[:bh * 8, :bw * 8].reshape(8, bh, 8, bw, 3)
+                block = (tiles.sum(axis=(1, 3), dtype=np.uint32) // (bh * bw)).astype(np.uint8)
+                # Spread each tile back over its pixels; the last row and column of tiles also cover the remainder
+                row_repeats = [bh] * 7 + [h - 7 * bh]
+                col_repeats = [bw] * 7 + [w - 7 * bw]
+                face_region[:] = np.repeat(np.repeat(block, row_repeats, axis=0), col_repeats, axis=1)
+            elif h and w:
+                # Too small for 8x8 tiles, a single one will do
+                face_region[:] = face_region.mean(axis=(0, 1))
         else:  # gaussianblur
             face_region = frame[top:bottom, left:right]
-            # Use separable filter for faster blur
-            blurred = cv2.GaussianBlur(face_region, (21, 21), 0)
+            # Rolling-sum blur instead of a Gaussian's per-tap multiply-adds
+            blurred = _fast_blur(face_region, (BLUR_KERNEL_SIZE, BLUR_KERNEL_SIZE))
             frame[top:bottom, left:right] = blurred
         
         return frame
 
+    def censor_faces(self, frame, face_locations):
+        """Censor each of face_locations in frame in place; all at once with numba (pixelation) or CUDA (gaussianblur)"""
+        if face_locations and self.censor_type == 'pixelation' and NUMBA_AVAILABLE:
+            boxes = np.array(face_locations, dtype=np.int64).reshape(-1, 4)
+            self.pixelation_kernel(frame)(frame, boxes)
+        elif face_locations and self.censor_type == 'gaussianblur' and CUDA_AVAILABLE:
+            _blur_faces_cuda(frame, self.clip_boxes(frame, face_locations))
+        else:
+            for face_location in face_locations:
+                frame = self.get_blurred_face_fast(frame, face_location)
+        return frame
+
+    def pixelation_kernel(self, frame):
+        """The pixelation kernel for frame's resolution, compiled (or loaded from numba's cache) once per size"""
+        key = frame.shape[:2]
+        if key not in self._kernel_cache:
+            self._kernel_cache[key] = _make_pixelate_kernel(*key)
+        return self._kernel_cache[key]
+
+    def clip_boxes(self, frame, face_locations):
+        """face_locations as an (n, 4) array, with the same boundary checks as get_blurred_face_fast"""
+        height, width = frame.shape[:2]
+        boxes = np.array(face_locations, dtype=np.int64).reshape(-1, 4)
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, height)
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, width)
+        return boxes
+
+    def match_encodings(self, face_encodings):
+        """match_faces against ref_matrix; with numba, on int8-quantized encodings"""
+        if not NUMBA_AVAILABLE:
+            return match_faces(self.ref_matrix, face_encodings)
+        # Rounding both sides adds 2 / 12 quantization step squared per dimension to the expected
+        # squared distance, so the tolerance is widened by as much to keep the same decisions on average
+        threshold = int((FACE_MATCH_TOLERANCE * INT8_ENCODING_SCALE) ** 2 + FACE_ENCODING_SIZE / 6)
+        return _match_faces_int8(quantize_encodings(face_encodings), self.ref_int8, threshold)
+
     def process_frame_batch(self, frames, face_locations_batch, reference_encodings=None, mode='all'):
         """Process a batch of frames in parallel"""
+        matches_batch = [None] * len(frames)
+        if mode in ['one', 'allexcept'] and reference_encodings:
+            # Encode the faces of the whole batch in one descriptor call and compare
+            # them all with every reference at once, then split the result per frame
+            face_encodings = encode_faces_batch(frames, face_locations_batch)
+            face_counts = np.cumsum([len(face_locations) for face_locations in face_locations_batch])
+            matches_batch = np.split(self.match_encodings(face_encodings), face_counts[:-1])
+        
         processed_frames = []
         
-        for frame, face_locations in zip(frames, face_locations_batch):
+        for frame, face_locations, matches in zip(frames, face_locations_batch, matches_batch):
             if mode == 'all':
                 # Blur all faces
-                for face_location in face_locations:
-                    frame = self.get_blurred_face_fast(frame, face_location)
+                frame = self.censor_faces(frame, face_locations)
             
             elif mode == 'one' and reference_encodings:
-                # Get face encodings for this frame
-                if face_locations:
-                    face_encodings = face_recognition.face_encodings(frame, face_locations)
-                    for face_encoding, face_location in zip(face_encodings, face_locations):
-                        # Check if this face matches any reference
-                        matches = face_recognition.compare_faces(reference_encodings, face_encoding, tolerance=0.6)
-                        if any(matches):
-                            frame = self.get_blurred_face_fast(frame, face_location)
+                # Check if this face matches any reference
+                frame = self.censor_faces(frame, [face_location for matched, face_location
+                                                  in zip(matches, face_locations) if matched])
             
             elif mode == 'allexcept' and reference_encodings:
-                # Get face encodings for this frame
-                if face_locations:
-                    face_encodings = face_recognition.face_encodings(frame, face_locations)
-                    for face_encoding, face_location in zip(face_encodings, face_locations):
-                        # Blur faces that DON'T match references
-                        matches = face_recognition.compare_faces(reference_encodings, face_encoding, tolerance=0.6)
-                        if not any(matches):
-                            frame = self.get_blurred_face_fast(frame, face_location)
+                # Blur faces that DON'T match references
+                frame = self.censor_faces(frame, [face_location for matched, face_location
+                                                  in zip(matches, face_locations) if not matched])
             
             processed_frames.append(frame)
         
@@ -112,109 +433,118 @@ class OptimizedVideoProcessor:
         
         # Open video
         video_capture = cv2.VideoCapture(video_path)
+        # read_frames already decodes ahead, so the backend needn't buffer frames of its own
+        video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         fps = video_capture.get(cv2.CAP_PROP_FPS)
         width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
         total_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
         
-        # Create video writer
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        temp_output = str(output_path).replace('.mp4', '_temp.mp4')
-        video_writer = cv2.VideoWriter(temp_output, fourcc, fps, (width, height))
-        
-        # Get reference encodings if needed
-        reference_encodings = []
-        if mode in ['one', 'allexcept'] and reference_faces:
-            for ref_path in reference_faces:
-                try:
-                    ref_image = face_recognition.load_image_file(ref_path)
-                    ref_encodings = face_recognition.face_encodings(ref_image)
-                    if ref_encodings:
-                        reference_encodings.append(ref_encodings[0])
-                except Exception as e:
-                    print(f"Error loading reference face {ref_path}: {e}")
-        
-        # Process video in batches
-        frame_count = 0
-        last_face_locations = []
-        frames_buffer = []
-        face_locations_buffer = []
+        # Batches go to the worker processes through a ring of shared memory blocks,
+        # so frames are never pickled; each worker blurs its frames in place
+        step = self.skip_frames if self.detect_only else 1
+        n_blocks = self.num_workers + 1  # one to fill while every worker is busy
+        frame_bytes = height * width * 3
+        shared_memory_budget = get_shared_memory_budget()
+        frames_per_batch = min(self.batch_size, max(1, shared_memory_budget // (frame_bytes * n_blocks)))
+        # a whole number of detection intervals, so that every batch starts on a detection frame
+        frames_per_batch = max(self.skip_frames, frames_per_batch - frames_per_batch % self.skip_frames)
+        if frame_bytes * frames_per_batch * n_blocks > shared_memory_budget:
+            video_capture.release()
+            raise RuntimeError(f"{n_blocks} blocks of {frames_per_batch} {width}x{height} frames don't fit in "
+                               f"{shared_memory_budget} bytes of shared memory; give /dev/shm more space")
         
-        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
-            while True:
-                ret, frame = video_capture.read()
-                if not ret:
-                    break
-                
-                # Smart frame skipping for face detection
-                if frame_count % self.skip_frames == 0:
-                    # Detect faces on this frame
-                    face_locations = self.detect_faces_scaled(frame)
-                    last_face_locations = face_locations
-                else:
-                    # Reuse previous face locations (assuming faces don't move much)
-                    face_locations = last_face_locations
-                
-                # Add to buffer
-                frames_buffer.append(frame)
-                face_locations_buffer.append(face_locations)
-                
-                # Process batch when full
-                if len(frames_buffer) >= self.batch_size:
-                    # Process this batch
-                    processed_frames = self.process_frame_batch(
-                        frames_buffer, 
-                        face_locations_buffer,
-                        reference_encodings,
-                        mode
-                    )
+        # Create video writer: frames are piped into one ffmpeg process, which encodes them
+        # with the fastest working encoder and muxes in the source audio in the same pass
+        output_fps = fps / self.skip_frames if self.detect_only else fps
+        if self.has_audio(video_path):
+            print("[OPTIMIZED] Adding audio track...")
+            audio_path = video_path
+        else:
+            audio_path = None
+        video_writer = None
+        blocks = []
+        views = []
+        try:
+            video_writer = FFmpegVideoWriter(output_path, width, height, output_fps, audio_path)
+            
+            # Get reference encodings if needed
+            reference_encodings = []
+            if mode in ['one', 'allexcept'] and reference_faces:
+                for ref_path in reference_faces:
+                    try:
+                        # Cached by image content, so a reference uploaded again is not re-encoded
+                        reference_encodings.append(get_cached_face_encoding(ref_path))
+                    except Exception as e:
+                        print(f"Error loading reference face {ref_path}: {e}")
+            self.ref_matrix = np.ascontiguousarray(
+                np.array(reference_encodings, dtype=np.float32).reshape(-1, FACE_ENCODING_SIZE))
+            self.ref_int8 = quantize_encodings(self.ref_matrix)
+            
+            # Process video in batches
+            block_shape = (frames_per_batch, height, width, 3)
+            for _ in range(n_blocks):
+                blocks.append(SharedMemory(create=True, size=frame_bytes * frames_per_batch))
+            views.extend(np.ndarray(block_shape, dtype=np.uint8, buffer=block.buf) for block in blocks)
+            free_blocks = deque(range(n_blocks))
+            pending = deque()
+            
+            def write_oldest():
+                # batches are written in the order they were read, whatever order they finish in
+                future, block_id, n_frames = pending.popleft()
+                future.result()
+                for frame in views[block_id][:n_frames]:
+                    video_writer.write(frame)
+                free_blocks.append(block_id)
+            
+            # spawn rather than fork: the reader thread and dlib's state must not be copied into workers
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_shared_worker,
+                initargs=(self, [block.name for block in blocks], block_shape, mode, reference_encodings)
+            ) as executor:
+                for batch in batched(enumerate(read_frames(video_capture, step=step)), frames_per_batch):
+                    # Index in the source video, counting dropped frames too
+                    frame_count = batch[0][0] * step
                     
-                    # Write processed frames
-                    for processed_frame in processed_frames:
-                        video_writer.write(processed_frame)
+                    # Update progress
+                    if progress_callback:
+                        progress = int((frame_count / max(total_frames, 1)) * 100)
+                        progress_callback(progress)
                     
-                    # Clear buffers
-                    frames_buffer = []
-                    face_locations_buffer = []
+                    if not free_blocks:
+                        write_oldest()
+                    block_id = free_blocks.popleft()
+                    for j, (_, frame) in enumerate(batch):
+                        views[block_id][j] = frame
+                    
+                    # Smart frame skipping for face detection: a fixed stride for detect_only, where it sets
+                    # the output frame rate, else left to the worker to decide from the motion in the batch
+                    detect_flags = None
+                    if self.detect_only:
+                        detect_flags = [(i * step) % self.skip_frames == 0 for i, _ in batch]
+                    future = executor.submit(_process_shared_batch, block_id, len(batch), detect_flags)
+                    pending.append((future, block_id, len(batch)))
                 
-                # Update progress
-                frame_count += 1
-                if progress_callback and frame_count % 10 == 0:
-                    progress = int((frame_count / total_frames) * 100)
-                    progress_callback(progress)
-            
-            # Process remaining frames
-            if frames_buffer:
-                processed_frames = self.process_frame_batch(
-                    frames_buffer, 
-                    face_locations_buffer,
-                    reference_encodings,
-                    mode
-                )
-                for processed_frame in processed_frames:
-                    video_writer.write(processed_frame)
-        
-        # Clean up
-        video_capture.release()
-        video_writer.release()
-        
-        # Add audio back if present
-        try:
-            if self.has_audio(video_path):
-                print("[OPTIMIZED] Adding audio track...")
-                in_av = ffmpeg.input(video_path)
-                video_stream = ffmpeg.input(temp_output)
-                stream = ffmpeg.output(
-                    video_stream, in_av.audio, str(output_path),
-                    vcodec='libx264', crf=23, preset='fast'
-                ).overwrite_output()
-                ffmpeg.run(stream, quiet=True)
-                os.remove(temp_output)
-            else:
-                os.rename(temp_output, output_path)
-        except Exception as e:
-            print(f"[OPTIMIZED] Error adding audio: {e}")
-            os.rename(temp_output, output_path)
+                while pending:
+                    write_oldest()
+            video_writer.release()
+        finally:
+            # Clean up, also when a worker or the encoder failed: app.py falls back to the standard
+            # path, which must not find this job's ffmpeg still writing the same output file
+            if video_writer is not None:
+                video_writer.abort()
+            video_capture.release()
+            # the views must go before their blocks can be closed
+            views.clear()
+            for block in blocks:
+                try:
+                    block.close()
+                except BufferError:
+                    # a failed batch's traceback still holds a view; the mapping is freed along with it
+                    pass
+                block.unlink()
         
         if progress_callback:
             progress_callback(100)
@@ -230,7 +560,7 @@ class OptimizedVideoProcessor:
 # Convenience function for backward compatibility
 def process_video_optimized(video_path, output_path, mode='all', model='hog', 
                           censor_type='gaussianblur', count=1, reference_faces=None, 
-                          progress_callback=None):
+                          progress_callback=None, detect_only=False):
     """Wrapper function for optimized processing"""
-    processor = OptimizedVideoProcessor(model, censor_type, count)
+    processor = OptimizedVideoProcessor(model, censor_type, count, detect_only)
     processor.process_video_optimized(video_path, output_path, mode, reference_faces, progress_callback) 
\ No newline at end of file
@@ -0,0 +1,95 @@
+#!/bin/bash
+
+# Build dlib from source with the SIMD instructions of this CPU, then install the rest of requirements.txt
+# Usage: ./build_dlib.sh [--pgo]
+#
+#   --pgo   profile-guided build: build an instrumented dlib, run HOG detection and face
+#           encoding on media/friends.mp4 to collect a profile, then rebuild dlib using it.
+#           Only this script, requirements.txt and the video are needed, so Docker can
+#           build dlib before copying the rest of the app
+#
+# DLIB_VERSION and DLIB_COMPILER_FLAGS override the defaults below. DLIB_USE_CUDA=1 builds
+# the CUDA detector and encoder (needs the CUDA toolkit and cuDNN). With PIP_USER=1 everything
+# is installed into the user site-packages, like pip install --user.
+
+set -e
+
+APP_DIR="$(cd "$(dirname "$0")" && pwd)"
+DLIB_VERSION="${DLIB_VERSION:-19.24.6}"
+
+case "$(uname -m)" in
+    x86_64)
+        DEFAULT_FLAGS="-O3 -mavx -mfma"
+        SIMD_OPTIONS="--set USE_SSE4_INSTRUCTIONS=1 --set USE_AVX_INSTRUCTIONS=1"
+        ;;
+    aarch64|arm64)
+        # NEON is always there on 64-bit ARM
+        DEFAULT_FLAGS="-O3"
+        SIMD_OPTIONS="--set USE_NEON_INSTRUCTIONS=1"
+        ;;
+    armv7l)
+        DEFAULT_FLAGS="-O3 -mfpu=neon"
+        SIMD_OPTIONS="--set USE_NEON_INSTRUCTIONS=1"
+        ;;
+    *)
+        DEFAULT_FLAGS="-O3"
+        SIMD_OPTIONS=""
+        ;;
+esac
+FLAGS="${DLIB_COMPILER_FLAGS:-$DEFAULT_FLAGS}"
+# pip reads PIP_USER by itself, setup.py needs to be told
+INSTALL_OPTIONS=""
+if [ "${PIP_USER:-0}" = "1" ]; then
+    INSTALL_OPTIONS="--user"
+fi
+
+BUILD_DIR="$(mktemp -d)"
+trap 'rm -rf "$BUILD_DIR"' EXIT
+
+echo "📦 Fetching dlib $DLIB_VERSION sources..."
+pip3 download "dlib==$DLIB_VERSION" --no-binary :all: --no-deps -d "$BUILD_DIR"
+tar xzf "$BUILD_DIR"/dlib-*.tar.gz -C "$BUILD_DIR"
+
+build_dlib() {
+    echo "🔨 Building dlib with: $1"
+    (cd "$BUILD_DIR/dlib-$DLIB_VERSION" && \
+        python3 setup.py install $INSTALL_OPTIONS $SIMD_OPTIONS --set DLIB_USE_CUDA="${DLIB_USE_CUDA:-0}" --compiler-flags "$1" --clean)
+}
+
+install_requirements() {
+    # dlib is already installed from source, so skip the prebuilt wheel
+    grep -v '^dlib-bin' "$APP_DIR/requirements.txt" | pip3 install -r /dev/stdin
+}
+
+if [ "$1" = "--pgo" ]; then
+    PROFILE_DIR="$BUILD_DIR/profile"
+    build_dlib "$FLAGS -fprofile-generate=$PROFILE_DIR"
+    install_requirements
+
+    echo "📈 Collecting a profile of the HOG pipeline..."
+    # the same dlib calls as blur_faces.py: HOG on a half-size grayscale frame, then encodings
+    python3 - "$APP_DIR/media/friends.mp4" <<'PROFILE'
+import sys
+import cv2
+import dlib
+import face_recognition
+
+detector = dlib.get_frontal_face_detector()
+video_capture = cv2.VideoCapture(sys.argv[1])
+while True:
+    ret, frame = video_capture.read()
+    if not ret:
+        break
+    gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    face_locations = [(rect.top() * 2, rect.right() * 2, rect.bottom() * 2, rect.left() * 2)
+                      for rect in detector(gray, 1)]
+    face_recognition.face_encodings(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), face_locations)
+PROFILE
+
+    build_dlib "$FLAGS -fprofile-use=$PROFILE_DIR -fprofile-partial-training -Wno-missing-profile"
+else
+    build_dlib "$FLAGS"
+    install_requirements
+fi
+
+python3 -c "import dlib; print(f'✅ dlib {dlib.__version__} installed (CUDA: {dlib.DLIB_USE_CUDA})')"
@@ -16,7 +16,7 @@ APP_DIR="/home/ec2-user/blurfaces"
 echo "📦 Creating deployment package..."
 # Create a temporary directory for deployment files
 mkdir -p deploy_temp
-cp blur_faces.py requirements.txt README.md deploy_temp/
+cp blur_faces.py build_dlib.sh requirements.txt README.md deploy_temp/
 cp -r media deploy_temp/ 2>/dev/null || echo "⚠️  media directory not found, skipping..."
 
 echo "🔄 Transferring files to EC2 instance..."
@@ -45,12 +45,15 @@ ssh -i "$SSH_KEY" "$EC2_USER@$EC2_HOST" << 'EOF'
     
     # Move files to app directory
     mv /home/ec2-user/blur_faces.py ./ 2>/dev/null || true
+    mv /home/ec2-user/build_dlib.sh ./ 2>/dev/null || true
     mv /home/ec2-user/requirements.txt ./ 2>/dev/null || true
     mv /home/ec2-user/README.md ./ 2>/dev/null || true
     mv /home/ec2-user/media ./ 2>/dev/null || true
     
-    # Install Python dependencies
-    pip3 install --user -r requirements.txt
+    # Install Python dependencies, with dlib compiled for this instance's CPU (AVX/FMA),
+    # which makes detection much faster than a generic build
+    chmod +x build_dlib.sh
+    PIP_USER=1 ./build_dlib.sh
     
     # Make the script executable
     chmod +x blur_faces.py
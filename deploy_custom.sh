@@ -44,7 +44,7 @@ fi
 echo -e "${YELLOW}📦 Creating deployment package...${NC}"
 # Create a temporary directory for deployment files
 mkdir -p deploy_temp
-cp blur_faces.py app.py requirements.txt README.md deploy_temp/
+cp blur_faces.py app.py job_store.py build_dlib.sh requirements.txt README.md deploy_temp/
 cp -r media deploy_temp/ 2>/dev/null || echo "⚠️  media directory not found, skipping..."
 cp -r static deploy_temp/ 2>/dev/null || echo "⚠️  static directory not found, creating..."
 mkdir -p deploy_temp/static
@@ -78,6 +78,8 @@ ssh -i "$SSH_KEY" "$EC2_USER@$EC2_HOST" << EOF
     echo "📂 Moving files to app directory..."
     mv ~/blur_faces.py ./ 2>/dev/null || true
     mv ~/app.py ./ 2>/dev/null || true
+    mv ~/job_store.py ./ 2>/dev/null || true
+    mv ~/build_dlib.sh ./ 2>/dev/null || true
     mv ~/requirements.txt ./ 2>/dev/null || true
     mv ~/README.md ./ 2>/dev/null || true
     mv ~/media ./ 2>/dev/null || true
@@ -87,7 +89,9 @@ ssh -i "$SSH_KEY" "$EC2_USER@$EC2_HOST" << EOF
     mkdir -p uploads processed static
     
     echo "🔧 Installing Python dependencies..."
-    pip3 install --user -r requirements.txt
+    # dlib is compiled for this instance's CPU (AVX/FMA), which makes detection much faster than a generic build
+    chmod +x build_dlib.sh
+    PIP_USER=1 ./build_dlib.sh
     
     echo "🛠️  Creating systemd service..."
     sudo tee /etc/systemd/system/blurfaces.service > /dev/null << 'SERVICE'
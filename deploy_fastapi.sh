@@ -16,7 +16,7 @@ APP_DIR="/home/ec2-user/blurfaces"
 echo "📦 Creating deployment package..."
 # Create a temporary directory for deployment files
 mkdir -p deploy_temp
-cp blur_faces.py app.py requirements.txt README.md deploy_temp/
+cp blur_faces.py app.py job_store.py build_dlib.sh requirements.txt README.md deploy_temp/
 cp -r media deploy_temp/ 2>/dev/null || echo "⚠️  media directory not found, skipping..."
 cp -r static deploy_temp/ 2>/dev/null || echo "⚠️  static directory not found, creating..."
 mkdir -p deploy_temp/static
@@ -49,6 +49,8 @@ ssh -i "$SSH_KEY" "$EC2_USER@$EC2_HOST" << 'EOF'
     # Move files to app directory
     mv /home/ec2-user/blur_faces.py ./ 2>/dev/null || true
     mv /home/ec2-user/app.py ./ 2>/dev/null || true
+    mv /home/ec2-user/job_store.py ./ 2>/dev/null || true
+    mv /home/ec2-user/build_dlib.sh ./ 2>/dev/null || true
     mv /home/ec2-user/requirements.txt ./ 2>/dev/null || true
     mv /home/ec2-user/README.md ./ 2>/dev/null || true
     mv /home/ec2-user/media ./ 2>/dev/null || true
@@ -57,8 +59,10 @@ ssh -i "$SSH_KEY" "$EC2_USER@$EC2_HOST" << 'EOF'
     # Create necessary directories
     mkdir -p uploads processed static
     
-    # Install Python dependencies
-    pip3 install --user -r requirements.txt
+    # Install Python dependencies, with dlib compiled for this instance's CPU (AVX/FMA),
+    # which makes detection much faster than a generic build
+    chmod +x build_dlib.sh
+    PIP_USER=1 ./build_dlib.sh
     
     # Create systemd service file
     sudo tee /etc/systemd/system/blurfaces.service > /dev/null << 'SERVICE'
@@ -8,8 +8,12 @@ import tempfile
 import shutil
 from pathlib import Path
 import asyncio
+import time
 from datetime import datetime
 
+# Skip probing the Media Foundation capture backend; videos are always opened through FFmpeg
+os.environ.setdefault("OPENCV_VIDEOIO_PRIORITY_MSMF", "0")
+
 # Import the blur faces functionality
 from blur_faces import get_video_properties, get_face_encoding, get_blurred_face, decode_fourcc, has_audio
 import cv2
@@ -17,6 +21,7 @@ import face_recognition
 import ffmpeg
 import numpy as np
 from tqdm import trange
+from job_store import JobStore
 
 app = FastAPI(title="BlurFaces API", version="1.0.0")
 
@@ -31,8 +36,23 @@ STATIC_DIR.mkdir(exist_ok=True)
 # Mount static files for processed videos
 app.mount("/processed", StaticFiles(directory="processed"), name="processed")
 
-# Store job status
-job_status = {}
+# Store job status; with REDIS_URL set it is shared by every uvicorn worker (--workers N)
+job_status = JobStore(os.environ.get("REDIS_URL"))
+
+# Uploads are copied to disk in blocks of this size instead of being read into memory whole
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Least time in seconds between two progress writes to the job store
+PROGRESS_UPDATE_INTERVAL = 0.25
+
+def copy_upload_to_disk(upload: UploadFile, output_path: Path) -> None:
+    """Copy an upload's spooled file to output_path in UPLOAD_CHUNK_SIZE blocks"""
+    with open(output_path, "wb") as f:
+        shutil.copyfileobj(upload.file, f, length=UPLOAD_CHUNK_SIZE)
+
+async def save_upload_file(upload: UploadFile, output_path: Path) -> None:
+    """Save an uploaded file to disk on the threadpool, so the event loop keeps serving other requests"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, copy_upload_to_disk, upload, output_path)
 
 @app.get("/")
 async def root():
@@ -74,11 +94,22 @@ async def process_video(
         
         # Output path
         output_path = PROCESSED_DIR / f"{job_id}.mp4"
-        temp_video_path = PROCESSED_DIR / f"{job_id}_temp.mp4"
         
-        # Create video writer
-        video_out = cv2.VideoWriter(
-            str(temp_video_path), int(fourcc), fps, (width, height)
+        # Pipe raw frames into a single ffmpeg process, which encodes them once
+        # and muxes in the audio of the upload
+        video = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='bgr24', s=f'{width}x{height}', r=fps)
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions: pad odd ones with one black row or column
+            video = video.filter('pad', 'ceil(iw/2)*2', 'ceil(ih/2)*2')
+        streams = [video]
+        if has_audio(video_path):
+            streams.append(ffmpeg.input(video_path).audio)
+        video_out = (
+            ffmpeg.output(*streams, str(output_path), vcodec='libx264', preset='ultrafast', crf=23,
+                          pix_fmt='yuv420p', movflags='+faststart')
+            .global_args('-hide_banner', '-loglevel', 'error')
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
         )
         
         # Get reference encodings if needed
@@ -92,14 +123,19 @@ async def process_video(
                     print(f"Error loading reference face {ref_face_path}: {e}")
         
         # Process frames
+        last_progress = 0
+        last_progress_time = time.monotonic()
         for i in range(length + 1):
             ret, frame = video_capture.read()
             if not ret:
                 break
             
-            # Update progress
-            progress = int((i / length) * 100)
-            job_status[job_id]["progress"] = progress
+            # Update progress, writing to the job store only when it changes
+            progress = min(99, int(100 * i / max(length, 1)))
+            if progress != last_progress and time.monotonic() - last_progress_time >= PROGRESS_UPDATE_INTERVAL:
+                job_status.update(job_id, progress=progress)
+                last_progress = progress
+                last_progress_time = time.monotonic()
             
             # Detect faces
             face_locations = face_recognition.face_locations(
@@ -127,24 +163,14 @@ async def process_video(
                     if not any(matches):
                         frame = get_blurred_face(frame, censor_type, face_location)
             
-            video_out.write(frame)
+            video_out.stdin.write(frame.tobytes())
         
         # Release resources
         video_capture.release()
-        video_out.release()
-        cv2.destroyAllWindows()
-        
-        # Add audio if present
-        if has_audio(video_path):
-            in_av = ffmpeg.input(video_path)
-            blurred_video = ffmpeg.input(str(temp_video_path))
-            stream = ffmpeg.output(
-                blurred_video, in_av.audio, str(output_path)
-            ).overwrite_output()
-            ffmpeg.run(stream, quiet=True)
-            os.remove(temp_video_path)
-        else:
-            shutil.move(str(temp_video_path), str(output_path))
+        video_out.stdin.close()
+        if video_out.wait() != 0:
+            raise Exception(f"ffmpeg exited with code {video_out.returncode} while encoding")
+        # Removed cv2.destroyAllWindows() - no GUI windows to destroy
         
         # Update job status
         job_status[job_id] = {
@@ -190,9 +216,7 @@ async def blur_all_faces(
     
     # Save uploaded video
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        content = await video.read()
-        f.write(content)
+    await save_upload_file(video, video_path)
     
     # Start background processing
     background_tasks.add_task(
@@ -236,17 +260,13 @@ async def blur_specific_faces(
     
     # Save uploaded video
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        content = await video.read()
-        f.write(content)
+    await save_upload_file(video, video_path)
     
     # Save reference faces
     ref_paths = []
     for i, ref_face in enumerate(reference_faces):
         ref_path = UPLOAD_DIR / f"{job_id}_ref_{i}_{ref_face.filename}"
-        with open(ref_path, "wb") as f:
-            content = await ref_face.read()
-            f.write(content)
+        await save_upload_file(ref_face, ref_path)
         ref_paths.append(str(ref_path))
     
     # Start background processing
@@ -292,17 +312,13 @@ async def blur_all_except_specific_faces(
     
     # Save uploaded video
     video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
-    with open(video_path, "wb") as f:
-        content = await video.read()
-        f.write(content)
+    await save_upload_file(video, video_path)
     
     # Save reference faces
     ref_paths = []
     for i, ref_face in enumerate(reference_faces):
         ref_path = UPLOAD_DIR / f"{job_id}_ref_{i}_{ref_face.filename}"
-        with open(ref_path, "wb") as f:
-            content = await ref_face.read()
-            f.write(content)
+        await save_upload_file(ref_face, ref_path)
         ref_paths.append(str(ref_path))
     
     # Start background processing
@@ -1,4 +1,6 @@
 import os
+# Skip probing the Media Foundation capture backend; videos are always opened through FFmpeg
+os.environ.setdefault('OPENCV_VIDEOIO_PRIORITY_MSMF', '0')
 import click
 import numpy as np
 import tempfile
@@ -142,7 +144,7 @@ def blurfaces(mode, model, censor_type, count, in_face_file, in_video_file):
                 video_out.write(frame)
 
         video_capture.release()
-        cv2.destroyAllWindows()
+        # Removed cv2.destroyAllWindows() - no GUI windows to destroy
 
         blurred_video_input = ffmpeg.input(out_video_file.name)
         streams = [blurred_video_input, a1] if a1 else [blurred_video_input]
@@ -0,0 +1,63 @@
+import json
+
+# Redis is optional: without it job status lives in this process only
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+
+class JobStore:
+    """Job status by job id, shared through Redis when a URL is given so every uvicorn worker sees every job"""
+
+    def __init__(self, redis_url=None):
+        self.jobs = {}
+        self.redis = None
+        if redis_url:
+            if not REDIS_AVAILABLE:
+                print("[WARNING] REDIS_URL is set but the redis package is not installed, keeping job status in memory")
+            else:
+                self.redis = redis.Redis.from_url(redis_url)
+                print(f"[INFO] Storing job status in Redis at {redis_url}")
+
+    @staticmethod
+    def _key(job_id):
+        return f"job:{job_id}"
+
+    def __setitem__(self, job_id, status):
+        """Replace the whole status of a job"""
+        if self.redis is None:
+            self.jobs[job_id] = dict(status)
+            return
+        key = self._key(job_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={field: json.dumps(value) for field, value in status.items()})
+        pipe.execute()
+
+    def update(self, job_id, **fields):
+        """Update some fields of a job's status, e.g. its progress"""
+        if self.redis is None:
+            self.jobs[job_id].update(fields)
+            return
+        self.redis.hset(self._key(job_id), mapping={field: json.dumps(value) for field, value in fields.items()})
+
+    def __getitem__(self, job_id):
+        if self.redis is None:
+            return self.jobs[job_id]
+        status = self.redis.hgetall(self._key(job_id))
+        if not status:
+            raise KeyError(job_id)
+        return {field.decode(): json.loads(value) for field, value in status.items()}
+
+    def __contains__(self, job_id):
+        if self.redis is None:
+            return job_id in self.jobs
+        return bool(self.redis.exists(self._key(job_id)))
+
+    def __delitem__(self, job_id):
+        if self.redis is None:
+            del self.jobs[job_id]
+            return
+        self.redis.delete(self._key(job_id))